@@ -1,7 +1,32 @@
+import select
 import socket
 import json
-import threading
-from datetime import datetime
+import struct
+import time
+
+import orjson
+
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 1 << 20
+SOCKET_BUFFER_SIZE = 4 << 20
+RECV_SIZE = 65536
+RECV_READS_PER_POLL = 4
+EMPTY_PAYLOAD = b"{}"
+MESSAGE_KINDS = (
+    ("register", "producer"),
+    ("register", "subscriber"),
+    ("message", "producer"),
+    ("withdraw", "producer"),
+    ("withdraw", "subscriber"),
+    ("status", ""),
+)
+
+
+def send_frame(sock, payload):
+    """
+    Sends payload preceded by its 4-byte big-endian length
+    """
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
 
 
 class ClientAPI:
@@ -12,124 +37,138 @@ class ClientAPI:
         self.socket = None
         self.connected = False
         self.client_id = None
+        self.envelopes = {}
+        self.timestamp_minute = None
+        self.timestamp_prefix = ""
+        self.received = bytearray()
+        self.recv_buffer = bytearray(RECV_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
 
     def get_timestamp(self):
         """
-        Returns current time based on format ISO 8601.
+        Returns current time based on format ISO 8601, with millisecond precision.
+        Date, hour and minute are only formatted again once the minute changes
         """
-        return datetime.utcnow().isoformat() + "Z"
+        minute, milliseconds = divmod(time.time_ns() // 1000000, 60000)
+        if minute != self.timestamp_minute:
+            self.timestamp_minute = minute
+            self.timestamp_prefix = time.strftime("%Y-%m-%dT%H:%M:", time.gmtime(minute * 60))
+        return f"{self.timestamp_prefix}{milliseconds / 1000:06.3f}Z"
 
     def start(self, client_id):
         """
         Establishes connection with server
         """
         self.client_id = client_id
+        self.build_envelopes()
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
             self.socket.connect((self.server_ip, self.server_port))
             self.connected = True
             self.client_window.log_to_console(
                 f"Connected to server {self.server_ip}:{self.server_port} as {self.client_id}")
-
-            threading.Thread(target=self.listen_for_messages).start()
         except Exception as e:
             self.client_window.log_to_console(f"Connection error: {e}")
 
-    def listen_for_messages(self):
-        """
-        Listens for messages from the server
-        """
-        while self.connected:
-            try:
-                response = self.socket.recv(1024).decode('utf-8')
-                if response:
-                    if response.startswith("{"):
-                        data = json.loads(response)
-                        topic = data.get("topic")
-                        message = data.get("payload")
-                        if topic and message and topic != "logs":
-                            self.client_window.log_to_console(f"Message received on topic: {topic}: {message}")
-                        elif data.get("type") == "status":
-                            self.display_status(data)
-                    else:
-                        self.client_window.log_to_console(response)
-            except Exception as e:
-                if self.connected:
-                    self.client_window.log_to_console(f"Failed to receive the message: {e}")
-                self.connected = False
+    def poll_messages(self):
+        """
+        Reads what the server has sent without blocking and handles every complete length-prefixed message.
+        Reads at most RECV_READS_PER_POLL chunks, so the GUI loop calling it periodically stays responsive
+        """
+        if not self.connected:
+            return
+        try:
+            for _ in range(RECV_READS_PER_POLL):
+                if not select.select([self.socket], [], [], 0)[0]:
+                    break
+                received = self.socket.recv_into(self.recv_view)
+                if not received:
+                    self.client_window.log_to_console("Connection closed by server")
+                    self.connected = False
+                    break
+                self.received += self.recv_view[:received]
+
+            offset = 0
+            with memoryview(self.received) as view:
+                while len(view) - offset >= FRAME_HEADER.size:
+                    (length,) = FRAME_HEADER.unpack_from(view, offset)
+                    if length > MAX_FRAME_SIZE:
+                        raise ValueError(f"frame of {length} bytes exceeds the limit of {MAX_FRAME_SIZE} bytes")
+                    start = offset + FRAME_HEADER.size
+                    if len(view) < start + length:
+                        break
+                    offset = start + length
+                    if length:
+                        self.handle_response(view[start:offset])
+            del self.received[:offset]
+        except Exception as e:
+            if self.connected:
+                self.client_window.log_to_console(f"Failed to receive the message: {e}")
+            self.connected = False
+
+    def handle_response(self, response):
+        """
+        Displays a single message received from the server, response is a view into the receive buffer
+        """
+        if response[:1] == b"{":
+            data = orjson.loads(response)
+            topic = data.get("topic")
+            message = data.get("payload")
+            if topic and message and topic != "logs":
+                self.client_window.log_to_console(f"Message received on topic: {topic}: {message}")
+            elif data.get("type") == "status":
+                self.display_status(data)
+        else:
+            self.client_window.log_to_console(str(response, 'utf-8'))
 
     def register_producer(self, topic_name):
-        message = {
-            "type": "register",
-            "id": self.client_id,
-            "topic": topic_name,
-            "mode": "producer",
-            "timestamp": self.get_timestamp(),
-            "payload": {}
-        }
-        self.send_message(message)
+        self.send_message(self.encode_message("register", "producer", topic_name))
 
     def register_subscriber(self, topic_name):
-        message = {
-            "type": "register",
-            "id": self.client_id,
-            "topic": topic_name,
-            "mode": "subscriber",
-            "timestamp": self.get_timestamp(),
-            "payload": {}
-        }
-        self.send_message(message)
+        self.send_message(self.encode_message("register", "subscriber", topic_name))
 
     def produce_message(self, topic_name, payload):
-        message = {
-            "type": "message",
-            "id": self.client_id,
-            "topic": topic_name,
-            "mode": "producer",
-            "timestamp": self.get_timestamp(),
-            "payload": payload
-        }
-        self.send_message(message)
+        self.send_message(self.encode_message("message", "producer", topic_name, orjson.dumps(payload)))
 
     def withdraw_producer(self, topic_name):
-        message = {
-            "type": "withdraw",
-            "id": self.client_id,
-            "topic": topic_name,
-            "mode": "producer",
-            "timestamp": self.get_timestamp(),
-            "payload": {}
-        }
-        self.send_message(message)
+        self.send_message(self.encode_message("withdraw", "producer", topic_name))
 
     def withdraw_subscriber(self, topic_name):
-        message = {
-            "type": "withdraw",
-            "id": self.client_id,
-            "topic": topic_name,
-            "mode": "subscriber",
-            "timestamp": self.get_timestamp(),
-            "payload": {}
-        }
-        self.send_message(message)
+        self.send_message(self.encode_message("withdraw", "subscriber", topic_name))
 
     def get_server_status(self):
-        message = {
-            "type": "status",
-            "id": self.client_id,
-            "topic": "logs",
-            "mode": "",
-            "timestamp": self.get_timestamp(),
-            "payload": {}
+        self.send_message(self.encode_message("status", "", "logs"))
+
+    def build_envelopes(self):
+        """
+        Precomputes the serialized fields that don't change between messages of the same type and mode
+        """
+        self.envelopes = {
+            (message_type, mode): orjson.dumps({"type": message_type, "id": self.client_id, "mode": mode})[:-1]
+            for message_type, mode in MESSAGE_KINDS
         }
-        self.send_message(message)
+
+    def encode_message(self, message_type, mode, topic_name, payload=EMPTY_PAYLOAD):
+        """
+        Builds a KOM from its precomputed envelope, only topic, timestamp and already serialized payload are appended
+        """
+        return b"".join((
+            self.envelopes[message_type, mode],
+            b',"topic":', orjson.dumps(topic_name),
+            b',"timestamp":', orjson.dumps(self.get_timestamp()),
+            b',"payload":', payload,
+            b"}",
+        ))
 
     def send_message(self, message):
         """
-        Sends a message to the server
+        Sends an encoded message to the server
         """
         try:
-            self.socket.send(json.dumps(message).encode('utf-8'))
+            send_frame(self.socket, message)
         except Exception as e:
             self.client_window.log_to_console(f"Failed to send a message: {e}")
 
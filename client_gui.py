@@ -1,7 +1,8 @@
+import collections
 import tkinter as tk
 from tkinter import messagebox
 from client_api import ClientAPI
-import json
+from config import load_config
 
 
 class ClientApp:
@@ -37,24 +38,12 @@ class ClientApp:
 
     def load_config(self):
         """
-        Loads server config from JSON file
-        Default ListenAddress: 127.0.0.1
-        Default ListenPort: 1234
-        """
-        try:
-            with open(self.config_file, 'r') as f:
-                config = json.load(f)
-                self.server_ip = config.get("ListenAddresses", ["127.0.0.1"])[0]
-                self.server_port = config.get("ListenPort", 1234)
-                print(f"Server config loaded: IP={self.server_ip}, port={self.server_port}")
-        except FileNotFoundError:
-            print(f"Error: File {self.config_file} not found. Using default config...")
-            self.server_ip = "127.0.0.1"
-            self.server_port = 1234
-        except json.JSONDecodeError:
-            print("Error: Incorrect JSON formatting. Using default config...")
-            self.server_ip = "127.0.0.1"
-            self.server_port = 1234
+        Loads server config, see config.load_config for defaults
+        """
+        config = load_config(self.config_file)
+        self.server_ip = config.address
+        self.server_port = config.port
+        print(f"Server config loaded: IP={self.server_ip}, port={self.server_port}")
 
     def client_id_input_field(self):
         """
@@ -92,9 +81,12 @@ class ClientWindow:
 
         self.console_output = tk.Text(root, height=20, width=50, state=tk.DISABLED)
         self.console_output.grid(row=6, columnspan=2, padx=5, pady=5)
+        self.console_buffer = collections.deque()
+        self.flush_job = self.root.after(33, self.flush_console)
 
         self.client = ClientAPI(server_ip, server_port, self)
         self.client.start(client_id)
+        self.root.after(10, self.poll_messages)
 
         self.topic_label = tk.Label(root, text="Topic:")
         self.topic_label.grid(row=0, column=0, padx=5, pady=5)
@@ -175,21 +167,40 @@ class ClientWindow:
             self.log_to_console("Error: Topic and message can't be empty!")
 
     def clear_console(self):
+        self.console_buffer.clear()
         self.console_output.config(state=tk.NORMAL)
         self.console_output.delete('1.0', tk.END)
         self.console_output.config(state=tk.DISABLED)
 
     def log_to_console(self, message):
         """
-        Displays the message in console
+        Queues the message to be displayed in console on the next flush
         """
-        self.console_output.config(state=tk.NORMAL)
-        self.console_output.insert(tk.END, f"{message}\n")
-        self.console_output.config(state=tk.DISABLED)
+        self.console_buffer.append(f"{message}\n")
+
+    def flush_console(self):
+        """
+        Displays queued messages with a single insert, about 30 times per second
+        """
+        if self.console_buffer:
+            self.console_output.config(state=tk.NORMAL)
+            self.console_output.insert(tk.END, "".join(self.console_buffer))
+            self.console_output.config(state=tk.DISABLED)
+            self.console_buffer.clear()
+        self.flush_job = self.root.after(33, self.flush_console)
+
+    def poll_messages(self):
+        """
+        Handles messages received from server on the Tk thread, reschedules itself while connected
+        """
+        if self.client.connected:
+            self.client.poll_messages()
+            self.root.after(10, self.poll_messages)
 
     def disconnect_client(self):
         """
         Disconnects client from server
         """
         self.client.stop()
+        self.root.after_cancel(self.flush_job)
         self.root.destroy()
@@ -0,0 +1,38 @@
+import functools
+import json
+from typing import NamedTuple
+
+
+class Config(NamedTuple):
+    server_id: str = "default_server"
+    address: str = "127.0.0.1"
+    port: int = 1234
+    timeout: int = 3
+
+
+DEFAULT_CONFIG = Config()
+
+
+@functools.lru_cache(maxsize=1)
+def load_config(config_file):
+    """
+    Loads config from JSON file once, later calls with the same file return the cached config.
+    Default ServerID: default_server
+    Default ListenAddress: 127.0.0.1
+    Default ListenPort: 1234
+    Default TimeOut: 3
+    """
+    try:
+        with open(config_file, 'r') as f:
+            config = json.load(f)
+        return Config(
+            server_id=config.get("ServerID", DEFAULT_CONFIG.server_id),
+            address=config.get("ListenAddresses", [DEFAULT_CONFIG.address])[0],
+            port=config.get("ListenPort", DEFAULT_CONFIG.port),
+            timeout=config.get("TimeOut", DEFAULT_CONFIG.timeout),
+        )
+    except FileNotFoundError:
+        print(f"Error: File {config_file} not found. Using default config...")
+    except json.JSONDecodeError:
+        print("Error: Incorrect JSON formatting. Using default config...")
+    return DEFAULT_CONFIG
@@ -1,9 +1,44 @@
+import asyncio
 import datetime
+import queue
 import socket
+import struct
 import threading
-import json
-import queue
-import time
+from typing import Any, Literal
+
+import msgspec
+import orjson
+
+from config import load_config
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 1 << 20
+SOCKET_BUFFER_SIZE = 4 << 20
+LISTEN_BACKLOG = 1024
+
+
+class KOM(msgspec.Struct):
+    """
+    Message sent by clients, validated while it's decoded
+    """
+    type: Literal["register", "withdraw", "message", "status"]
+    id: str
+    topic: str
+    mode: str
+    timestamp: datetime.datetime
+    payload: Any
+
+    def __post_init__(self):
+        if self.mode not in ("producer", "subscriber") and self.type != "status":
+            raise ValueError(f"Invalid mode {self.mode!r} for {self.type!r} message")
+
+
+kom_decoder = msgspec.json.Decoder(KOM)
 
 
 class Server:
@@ -16,267 +51,262 @@ class Server:
         self.load_config()
         self.server_socket = None
         self.topics = {}
-        self.lock = threading.Lock()
-        self.kko = queue.Queue()
-        self.kkw = queue.Queue()
-        self.callback_kkw = None
+        self.client_topics = {}
+        self.peers = {}
+        self.connection_event = None
+        self.log_queue = queue.SimpleQueue()
 
     def load_config(self):
         """
-        Loads server config from JSON file.
-        Default ServerID: default_server
-        Default ListenAddress: 127.0.0.1
-        Default ListenPort: 1234
-        Default TimeOut: 3
+        Loads server config, see config.load_config for defaults
         """
-        try:
-            with open(self.config_file, 'r') as f:
-                config = json.load(f)
-                self.address = config.get("ListenAddresses", ["127.0.0.1"])[0]
-                self.port = config.get("ListenPort", 1234)
-                self.timeout = config.get("TimeOut", 3)
-                self.server_id = config.get("ServerID", "default_server")
-            print(f"Config loaded: host={self.address}, port={self.port}, timeout={self.timeout}")
-        except FileNotFoundError:
-            print(f"Error: File {self.config_file} not found. Using default config...")
-            self.address = '127.0.0.1'
-            self.port = 1234
-            self.timeout = 3
-            self.server_id = 'default_server'
-        except json.JSONDecodeError:
-            print("Error: Incorrect JSON formatting. Using default config...")
-            self.address = '127.0.0.1'
-            self.port = 1234
-            self.timeout = 3
-            self.server_id = 'default_server'
+        config = load_config(self.config_file)
+        self.server_id = config.server_id
+        self.address = config.address
+        self.port = config.port
+        self.timeout = config.timeout
+        print(f"Config loaded: host={self.address}, port={self.port}, timeout={self.timeout}")
 
     def start(self):
         """
         Starts the server and waits for incoming clients
         """
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((self.address, self.port))
-        self.server_socket.listen(5)
-        print(f"Server '{self.server_id}' listening on {self.address}:{self.port} with timeout of {self.timeout} seconds")
-
-        self.register_kkw_callback(self.on_message_sent)
+        threading.Thread(target=self.write_log, daemon=True).start()
 
-        threading.Thread(target=self.handle_outgoing_messages).start()
-        threading.Thread(target=self.monitor_topics).start()
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
         try:
-            while True:
-                self.server_socket.settimeout(self.timeout)
-                try:
-                    client_socket, client_address = self.server_socket.accept()
-                    print(f"Connected with {client_address}")
-                    threading.Thread(target=self.handle_client, args=(client_socket,)).start()
-                except TimeoutError:
-                    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    print(f"[{current_time}] No new connections, server is waiting...")
-                    continue
+            asyncio.run(self.serve())
         except KeyboardInterrupt:
             print("Stopping server...")
-        finally:
-            self.server_socket.close()
 
-    def monitor_topics(self):
+    async def serve(self):
         """
-        Monitoring thread that handles KKO, topics and subscriptions
+        Runs the event loop's listener, one coroutine is scheduled per connected client
         """
-        while True:
-            if self.kko.empty():
-                time.sleep(0.001)
-                continue
-
-            client_socket, data = self.kko.get()
-            if not self.validate_kom(data):
-                print(f"Validation unsuccesful: {data}")
-                continue
+        self.connection_event = asyncio.Event()
+        self.server_socket = await asyncio.start_server(self.handle_client, self.address, self.port,
+                                                        backlog=LISTEN_BACKLOG)
+        print(f"Server '{self.server_id}' listening on {self.address}:{self.port} with timeout of {self.timeout} seconds")
 
-            self.process_message(data, client_socket)
-            print(data)
-            self.kko.task_done()
+        async with self.server_socket:
+            while True:
+                try:
+                    await asyncio.wait_for(self.connection_event.wait(), self.timeout)
+                    self.connection_event.clear()
+                except asyncio.TimeoutError:
+                    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    print(f"[{current_time}] No new connections, server is waiting...")
 
-    def validate_kom(self, data):
+    def on_message_sent(self, writer, message):
         """
-        Validation of KOM, based specified format
+        Called after each message sent to client
+        Queues the message to be logged to log.txt file
         """
-        try:
-            required_keys = ["type", "id", "topic", "mode", "timestamp", "payload"]
-            for key in required_keys:
-                if key not in data:
-                    return False
+        log_entry = f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Message to {self.peers.get(writer) or writer.get_extra_info('peername')}: {message.decode('utf-8')}\n"
+        self.log_queue.put(log_entry)
 
-            datetime.datetime.fromisoformat(data["timestamp"])
-
-            if data["type"] not in ["register", "withdraw", "message", "status"]:
-                return False
-
-            if data["mode"] not in ["producer", "subscriber"] and not data["type"] in ["status"]:
-                return False
-
-            return True
-        except Exception as e:
-            print(f"Validation failed: {e}")
-            return False
-
-    def register_kkw_callback(self, callback):
+    def write_log(self):
         """
-        Registers callback, which will be called after each change in KKW
+        Runs in a background thread, keeps log.txt open and flushes it once the queue of entries is empty.
+        After a failed write the file is reopened for the next entry, so the queue keeps being drained
         """
-        self.callback_kkw = callback
-
-    def on_message_sent(self, client_socket, message):
+        log_file = None
+        while True:
+            log_entry = self.log_queue.get()
+            try:
+                if log_file is None:
+                    log_file = open("log.txt", "a", buffering=8192)
+                log_file.write(log_entry)
+                if self.log_queue.empty():
+                    log_file.flush()
+            except IOError as e:
+                print(f"Failed to write into log.txt: {e}")
+                if log_file is not None:
+                    try:
+                        log_file.close()
+                    except IOError:
+                        pass
+                    log_file = None
+
+    async def send(self, writer, message):
         """
-        Callback function called after each message sent to client
-        Logs the message to log.txt file
+        Sends a length-prefixed message to client. Text messages are UTF-8 encoded, bytes are sent as is
         """
-        log_entry = f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Message to {client_socket.getpeername()}: {message}\n"
-
         try:
-            with open("log.txt", "a") as log_file:
-                log_file.write(log_entry)
-        except IOError as e:
-            print(f"Failed to write into log.txt: {e}")
+            payload = message if isinstance(message, bytes) else message.encode('utf-8')
+            writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+            await writer.drain()
+            self.on_message_sent(writer, payload)
+        except Exception as e:
+            print(f"Failed to send the message: {e}")
 
-    def handle_outgoing_messages(self):
+    async def broadcast(self, writers, payload):
         """
-        Thread that processes messages from KKW
+        Sends the same length-prefixed message to many clients, their buffers are drained concurrently
         """
-        while True:
-            if not self.kkw.empty():
-                client_socket, message = self.kkw.get()
-                try:
-                    client_socket.send(message.encode('utf-8'))
-                    if self.callback_kkw:
-                        self.callback_kkw(client_socket, message)
-                except Exception as e:
-                    print(f"Failed to send the message: {e}")
+        header = FRAME_HEADER.pack(len(payload))
+        for writer in writers:
+            writer.writelines((header, payload))
+
+        results = await asyncio.gather(*(writer.drain() for writer in writers), return_exceptions=True)
+        for writer, result in zip(writers, results):
+            if isinstance(result, Exception):
+                print(f"Failed to send message to a subscriber: {result}")
+            else:
+                self.on_message_sent(writer, payload)
+
+    def configure_socket(self, sock):
+        """
+        Disables Nagle's algorithm for small control messages and enlarges buffers for broadcast bursts
+        """
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        except OSError as e:
+            print(f"Failed to set socket options: {e}")
 
-    def handle_client(self, client_socket):
+    async def handle_client(self, reader, writer):
         """
-        Processes clients' connections
+        Processes clients' connections, each KOM is preceded by its 4-byte big-endian length
         """
+        self.peers[writer] = str(writer.get_extra_info('peername'))
+        print(f"Connected with {self.peers[writer]}")
+        self.configure_socket(writer.get_extra_info('socket'))
+        self.connection_event.set()
         try:
             while True:
-                message = client_socket.recv(1024).decode('utf-8')
-                if not message:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                    (length,) = FRAME_HEADER.unpack(header)
+                    if length > MAX_FRAME_SIZE:
+                        print(f"Frame of {length} bytes exceeds the limit of {MAX_FRAME_SIZE} bytes, dropping connection.")
+                        break
+                    message = await reader.readexactly(length)
+                except asyncio.IncompleteReadError:
                     break
-                data = json.loads(message)
-
-                self.kko.put((client_socket, data))
+                try:
+                    data = kom_decoder.decode(message)
+                except msgspec.DecodeError as e:
+                    print(f"Validation unsuccesful: {e}")
+                    continue
 
-                threading.Thread(target=self.process_received_messages).start()
+                await self.process_message(data, writer)
+                print(data)
 
         except Exception as e:
             print(f"Connection error: {e}")
         finally:
-            self.handle_disconnection(client_socket)
-            client_socket.close()
+            await self.handle_disconnection(writer)
+            del self.peers[writer]
+            writer.close()
 
-    def handle_disconnection(self, client_socket):
+    async def handle_disconnection(self, writer):
         """
         Handles client's disconnection. Deletes their subscriptions and/or topics, of which he was a producer
         """
-        with self.lock:
-            topics_to_remove = []
-            for topic, info in list(self.topics.items()):
-                if info["producer"] == client_socket:
-                    print(f"Producer of topic {topic} disconnected. Deleting topic.")
-                    topics_to_remove.append(topic)
-
-                if client_socket in info["subscribers"]:
-                    print(f"Subscriber of topic {topic} disconnected. Deleting subscription.")
-                    self.topics[topic]["subscribers"].remove(client_socket)
-
-            for topic in topics_to_remove:
-                del self.topics[topic]
-                print(f"Topic {topic} has been removed.")
-
-    def process_received_messages(self):
+        client_topics = self.client_topics.get(writer)
+        if client_topics is None:
+            return
+
+        for topic in client_topics["subscriber"]:
+            print(f"Subscriber of topic {topic} disconnected. Deleting subscription.")
+            self.topics[topic]["subscribers"].discard(writer)
+        client_topics["subscriber"].clear()
+
+        for topic in list(client_topics["producer"]):
+            print(f"Producer of topic {topic} disconnected. Deleting topic.")
+            self.remove_topic(topic)
+            print(f"Topic {topic} has been removed.")
+
+        del self.client_topics[writer]
+
+    def get_client_topics(self, writer):
+        """
+        Returns topics in which client takes part, as a producer and as a subscriber
+        """
+        if writer not in self.client_topics:
+            self.client_topics[writer] = {"producer": set(), "subscriber": set()}
+        return self.client_topics[writer]
+
+    def remove_topic(self, topic):
         """
-        Processes messages received from KKO
+        Deletes topic and drops it from its producer's and subscribers' topic sets
         """
-        while not self.kko.empty():
-            client_socket, data = self.kko.get()
-            self.process_message(data, client_socket)
+        info = self.topics.pop(topic)
+        self.client_topics[info["producer"]]["producer"].discard(topic)
+        for subscriber in info["subscribers"]:
+            self.client_topics[subscriber]["subscriber"].discard(topic)
 
-    def process_message(self, data, client_socket):
+    async def process_message(self, data, writer):
         """
         Processes messages from clients: register, withdraw, message, status
         """
-        message_type = data.get("type")
-        topic = data.get("topic")
-        client_id = data.get("id")
-
-        if message_type == "register" and data.get("mode") == "producer":
-            with self.lock:
-                if topic in self.topics:
-                    if self.topics[topic]["producer"] == client_socket:
-                        self.kkw.put((client_socket, f"You already are the producer of topic {topic}."))
-                    else:
-                        self.kkw.put((client_socket, f"Topic {topic} already exists."))
+        message_type = data.type
+        topic = data.topic
+        client_id = data.id
+
+        if message_type == "register" and data.mode == "producer":
+            if topic in self.topics:
+                if self.topics[topic]["producer"] == writer:
+                    await self.send(writer, f"You already are the producer of topic {topic}.")
                 else:
-                    self.topics[topic] = {"producer": client_socket, "producer_id": client_id, "subscribers": []}
-                    self.kkw.put((client_socket, f"New topic registered: {topic}"))
-
-        elif message_type == "register" and data.get("mode") == "subscriber":
-            with self.lock:
-                if topic in self.topics:
-                    if client_socket in self.topics[topic]["subscribers"]:
-                        self.kkw.put((client_socket, f"You already are a subscriber of topic {topic}."))
-                    else:
-                        self.topics[topic]["subscribers"].append(client_socket)
-                        self.kkw.put((client_socket, f"Subscribed to topic: {topic}"))
+                    await self.send(writer, f"Topic {topic} already exists.")
+            else:
+                self.topics[topic] = {"producer": writer, "producer_id": client_id, "subscribers": set()}
+                self.get_client_topics(writer)["producer"].add(topic)
+                await self.send(writer, f"New topic registered: {topic}")
+
+        elif message_type == "register" and data.mode == "subscriber":
+            if topic in self.topics:
+                if writer in self.topics[topic]["subscribers"]:
+                    await self.send(writer, f"You already are a subscriber of topic {topic}.")
                 else:
-                    self.kkw.put((client_socket, f"Topic {topic} doesn't exist."))
-
-        elif message_type == "withdraw" and data.get("mode") == "subscriber":
-            with self.lock:
-                if topic in self.topics:
-                    if client_socket in self.topics[topic]["subscribers"]:
-                        self.topics[topic]["subscribers"].remove(client_socket)
-                        self.kkw.put((client_socket, f"Subscription of topic {topic} has been withdrawn."))
-                    else:
-                        self.kkw.put((client_socket, f"You are not a subscriber of topic {topic}."))
+                    self.topics[topic]["subscribers"].add(writer)
+                    self.get_client_topics(writer)["subscriber"].add(topic)
+                    await self.send(writer, f"Subscribed to topic: {topic}")
+            else:
+                await self.send(writer, f"Topic {topic} doesn't exist.")
+
+        elif message_type == "withdraw" and data.mode == "subscriber":
+            if topic in self.topics:
+                if writer in self.topics[topic]["subscribers"]:
+                    self.topics[topic]["subscribers"].remove(writer)
+                    self.client_topics[writer]["subscriber"].discard(topic)
+                    await self.send(writer, f"Subscription of topic {topic} has been withdrawn.")
                 else:
-                    self.kkw.put((client_socket, f"Topic {topic} doesn't exist."))
-
-        elif message_type == "withdraw" and data.get("mode") == "producer":
-            with self.lock:
-                if topic in self.topics:
-                    if self.topics[topic]["producer"] == client_socket:
-                        del self.topics[topic]
-                        self.kkw.put((client_socket, f"Topic {topic} has been withdrawn."))
-                    else:
-                        self.kkw.put((client_socket, f"You are not a producer of topic {topic}."))
+                    await self.send(writer, f"You are not a subscriber of topic {topic}.")
+            else:
+                await self.send(writer, f"Topic {topic} doesn't exist.")
+
+        elif message_type == "withdraw" and data.mode == "producer":
+            if topic in self.topics:
+                if self.topics[topic]["producer"] == writer:
+                    self.remove_topic(topic)
+                    await self.send(writer, f"Topic {topic} has been withdrawn.")
                 else:
-                    self.kkw.put((client_socket, f"Topic {topic} doesn't exist."))
+                    await self.send(writer, f"You are not a producer of topic {topic}.")
+            else:
+                await self.send(writer, f"Topic {topic} doesn't exist.")
 
         elif message_type == "message":
-            payload = data.get("payload")
-            with self.lock:
-                if topic in self.topics:
-                    if self.topics[topic]["producer"] == client_socket:
-                        subscribers = self.topics[topic]["subscribers"]
-                        for sub in subscribers:
-                            try:
-                                self.kkw.put((sub, json.dumps({"topic": topic, "payload": payload})))
-                            except:
-                                print(f"Failed to send message to a subscriber")
-                    else:
-                        self.kkw.put((client_socket, f"You are not a producer of topic {topic}."))
+            payload = data.payload
+            if topic in self.topics:
+                if self.topics[topic]["producer"] == writer:
+                    encoded = orjson.dumps({"topic": topic, "payload": payload})
+                    await self.broadcast(tuple(self.topics[topic]["subscribers"]), encoded)
                 else:
-                    self.kkw.put((client_socket, f"Topic {topic} doesn't exist."))
+                    await self.send(writer, f"You are not a producer of topic {topic}.")
+            else:
+                await self.send(writer, f"Topic {topic} doesn't exist.")
 
         elif message_type == "status":
-            with self.lock:
-                topics_status = [{"topic": t, "id": self.topics[t]["producer_id"]} for t in self.topics]
-                data["payload"] = topics_status
-                self.kkw.put((client_socket, json.dumps(data)))
+            topics_status = [{"topic": t, "id": self.topics[t]["producer_id"]} for t in self.topics]
+            await self.send(writer, msgspec.json.encode(msgspec.structs.replace(data, payload=topics_status)))
         else:
-            self.kkw.put((client_socket, "Unknown message type."))
+            await self.send(writer, "Unknown message type.")
 
 
 if __name__ == "__main__":